@@ -4,19 +4,43 @@ import logging
 
 from functools import partial
 
-from moltin_api import add_product_to_cart
+from catalog_snapshot import RECOVERY_CHECK_INTERVAL
+from catalog_snapshot import SNAPSHOT_REFRESH_INTERVAL
+from catalog_snapshot import change_cart
+from catalog_snapshot import check_upstream
+from catalog_snapshot import fetch_file
+from catalog_snapshot import fetch_products
+from catalog_snapshot import get_photo_id
+from catalog_snapshot import is_degraded
+from catalog_snapshot import refresh_snapshot
+from catalog_snapshot import replay_cart_actions
+from catalog_snapshot import save_photo_id
 from moltin_api import create_a_customer
 from moltin_api import get_cart_status
-from moltin_api import get_files
-from moltin_api import get_products
+from moltin_api import get_coalescing_stats
 from moltin_api import load_environment
-from moltin_api import remove_item_from_cart
+from state_machine import MESSAGE_ACTION
+from state_machine import compile_states
+from state_machine import dispatch
+from state_machine import encode_callback
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Filters, Updater
 from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler
 from textwrap import dedent
 
+DEGRADED_MODE_MESSAGE = 'Магазин временно работает в режиме просмотра.'
+STATS_LOG_INTERVAL = 300
+
+MENU = 'm'
+CART = 'c'
+PRODUCT = 'p'
+ADD = 'a'
+DELETE = 'd'
+PAY = 'y'
+CUSTOMER = 'e'
+WRONG_EMAIL = 'w'
+
 
 def _error(_, context):
     """Собираем ошибки"""
@@ -24,6 +48,29 @@ def _error(_, context):
     logging.exception(context.error)
 
 
+def _check_moltin(context):
+    """
+    Фоновая задача: проверяет, восстановился ли Moltin, и выполняет
+     отложенные действия с корзинами
+    """
+    check_upstream(context.bot_data)
+    replay_cart_actions(context.bot_data)
+
+
+def _refresh_snapshot(context):
+    """Фоновая задача: обновляет снимок каталога"""
+    refresh_snapshot(context.bot_data)
+
+
+def _log_coalescing_stats(_):
+    """Фоновая задача: пишет в лог счетчики объединения запросов к API"""
+    stats = get_coalescing_stats()
+    logging.info(
+        f"Moltin GET requests: {stats['requests']}, "
+        f"collapsed: {stats['collapsed']}"
+    )
+
+
 def start(update, context):
     """
     Функция start - запуск бота (функция partial_handle_users_reply)
@@ -31,22 +78,25 @@ def start(update, context):
     """
 
     keyboard = list()
-    products = get_products(
-        context.bot_data['api_base_url'],
-        context.bot_data['client_id'],
-        context.bot_data['client_secret'],
-    )
+    products = fetch_products(context.bot_data)
 
     for product in products['data']:
         product_id = str(product['id'])
         keyboard.append(
             [
-                InlineKeyboardButton(product['name'], callback_data=product_id)
+                InlineKeyboardButton(
+                    product['name'],
+                    callback_data=encode_callback(PRODUCT, product_id)
+                )
             ]
         )
-    keyboard.append([InlineKeyboardButton('Корзина', callback_data='/cart')])
+    keyboard.append(
+        [InlineKeyboardButton('Корзина', callback_data=encode_callback(CART))]
+    )
     reply_markup = InlineKeyboardMarkup(keyboard)
     message = 'Список предложений:'
+    if is_degraded():
+        message += f'\n{DEGRADED_MODE_MESSAGE}'
     if update.message:
         update.message.reply_text(text=message, reply_markup=reply_markup)
         update.message.delete()
@@ -60,19 +110,14 @@ def start(update, context):
     return "HANDLE_MENU"
 
 
-def handle_menu(update, context):
+def handle_menu(update, context, product_id):
     """Предложение и выбор товара"""
 
     query = update.callback_query
 
-    if query.data == '/cart':
-        return handle_cart(update, context)
-
-    product_description = get_products(
-        context.bot_data['api_base_url'],
-        context.bot_data['client_id'],
-        context.bot_data['client_secret'],
-        product_id=query.data
+    product_description = fetch_products(
+        context.bot_data,
+        product_id=product_id
     )['data']
 
     unit_price = \
@@ -82,71 +127,67 @@ def handle_menu(update, context):
     Описание: {product_description['description']}
     Цена: {unit_price} за килограмм'''
 
-    file_id = product_description['relationships']['main_image']['data']['id']
-    file_description = get_files(
-        context.bot_data['api_base_url'],
-        context.bot_data['client_id'],
-        context.bot_data['client_secret'],
-        file_id=file_id
-    )
-    file_url = file_description['data']['link']['href']
+    photo = None
+    if is_degraded():
+        photo = get_photo_id(context.bot_data, product_id)
+    if not photo:
+        file_id = \
+            product_description['relationships']['main_image']['data']['id']
+        file_description = fetch_file(context.bot_data, file_id)
+        photo = file_description['data']['link']['href']
 
     keyboard = [
         [
-            InlineKeyboardButton('1кг', callback_data=f'{query.data}>1'),
-            InlineKeyboardButton('5кг', callback_data=f'{query.data}>5'),
-            InlineKeyboardButton('10кг', callback_data=f'{query.data}>10'),
+            InlineKeyboardButton(
+                f'{quantity}кг',
+                callback_data=encode_callback(ADD, product_id, quantity)
+            )
+            for quantity in (1, 5, 10)
         ],
-        [InlineKeyboardButton('Назад', callback_data='/back')],
-        [InlineKeyboardButton('Корзина', callback_data='/cart')],
+        [InlineKeyboardButton('Назад', callback_data=encode_callback(MENU))],
+        [InlineKeyboardButton('Корзина', callback_data=encode_callback(CART))],
     ]
 
     reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_photo(
-        photo=file_url,
+    photo_message = query.message.reply_photo(
+        photo=photo,
         caption=dedent(message),
         reply_markup=reply_markup
     )
+    save_photo_id(
+        context.bot_data,
+        product_id,
+        photo_message.photo[-1].file_id
+    )
     query.message.delete()
 
     query.answer()
     return "HANDLE_DESCRIPTION"
 
 
-def handle_description(update, context):
+def handle_description(update, context, purchase_id, purchase_quantity):
     """Добавление определенного кол-ва товара в корзину"""
 
     query = update.callback_query
-
-    if '/back' == query.data:
-        return start(update, context)
-    elif '/cart' == query.data:
-        return handle_cart(update, context)
-
-    purchase = str(query.data).split('>')
-    purchase_id = purchase[0]
-    purchase_quantity = int(purchase[1])
+    purchase_quantity = int(purchase_quantity)
 
     chat_id = update.effective_message.chat_id
-    add_product_to_cart(
-        context.bot_data['api_base_url'],
-        context.bot_data['client_id'],
-        context.bot_data['client_secret'],
+    is_added = change_cart(
+        context.bot_data,
+        'add',
         chat_id,
         purchase_id,
         purchase_quantity
     )
 
     keyboard = [
-        [InlineKeyboardButton('Назад', callback_data='/back')],
-        [InlineKeyboardButton('Корзина', callback_data='/cart')],
+        [InlineKeyboardButton('Назад', callback_data=encode_callback(MENU))],
+        [InlineKeyboardButton('Корзина', callback_data=encode_callback(CART))],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    product_description = get_products(
-        context.bot_data['api_base_url'],
-        context.bot_data['client_id'],
-        context.bot_data['client_secret'],
+    product_description = fetch_products(
+        context.bot_data,
         product_id=purchase_id
     )['data']
 
@@ -154,6 +195,13 @@ def handle_description(update, context):
     В корзину добавлен товар:
     {product_description['name']}.
     Количество: {purchase_quantity} килограмм'''
+    if not is_added:
+        message = f'''\
+    Товар будет добавлен в корзину позже:
+    {product_description['name']}.
+    Количество: {purchase_quantity} килограмм'''
+        if is_degraded():
+            message = f'    {DEGRADED_MODE_MESSAGE}\n{message}'
 
     query.message.reply_text(text=dedent(message), reply_markup=reply_markup)
     query.message.delete()
@@ -162,25 +210,31 @@ def handle_description(update, context):
     return "HANDLE_DESCRIPTION"
 
 
-def handle_cart(update, context):
-    """Работа с корзиной"""
+def handle_cart(update, context, product_id=None):
+    """Работа с корзиной. Если передан product_id, товар удаляется"""
 
     chat_id = update.effective_message.chat_id
     query = update.callback_query
 
-    if '/pay' == query.data:
-        return handle_email(update, context)
-    elif '/back' == query.data:
-        return start(update, context)
-    elif 'delete>' in query.data:
-        product_id = str(query.data).split('>')[1]
-        remove_item_from_cart(
-            context.bot_data['api_base_url'],
-            context.bot_data['client_id'],
-            context.bot_data['client_secret'],
-            chat_id,
-            product_id
-        )
+    if product_id:
+        change_cart(context.bot_data, 'remove', chat_id, product_id)
+
+    if is_degraded():
+        keyboard = [
+            [
+                InlineKeyboardButton(
+                    'В меню',
+                    callback_data=encode_callback(MENU)
+                )
+            ]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        message = f'{DEGRADED_MODE_MESSAGE}\nКорзина временно недоступна.'
+        query.message.reply_text(text=message, reply_markup=reply_markup)
+        query.message.delete()
+
+        query.answer()
+        return 'HANDLE_CART'
 
     cart_status = get_cart_status(
         context.bot_data['api_base_url'],
@@ -216,7 +270,7 @@ def handle_cart(update, context):
             [
                 InlineKeyboardButton(
                     f"Удалить: {product['name']}",
-                    callback_data=f"delete>{product['id']}"
+                    callback_data=encode_callback(DELETE, product['id'])
                 )
             ]
         )
@@ -226,8 +280,14 @@ def handle_cart(update, context):
 
     keyboard.append(
         [
-            InlineKeyboardButton('В меню', callback_data='/back'),
-            InlineKeyboardButton('Оплатить', callback_data='/pay')
+            InlineKeyboardButton(
+                'В меню',
+                callback_data=encode_callback(MENU)
+            ),
+            InlineKeyboardButton(
+                'Оплатить',
+                callback_data=encode_callback(PAY)
+            )
         ],
     )
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -240,54 +300,109 @@ def handle_cart(update, context):
 
 
 def handle_email(update, context):
-    """Функция, которая создает пользователя на основе полученного email"""
+    """Подтверждение полученного от пользователя email"""
 
-    if update.message:
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    'Верно',
-                    callback_data=f'/create_customer>{update.message.text}'
-                ),
-                InlineKeyboardButton('Я ошибся', callback_data='/wrong_email')
-            ],
-        ]
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                'Верно',
+                callback_data=encode_callback(CUSTOMER, update.message.text)
+            ),
+            InlineKeyboardButton(
+                'Я ошибся',
+                callback_data=encode_callback(WRONG_EMAIL)
+            )
+        ],
+    ]
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-        message = f'Вы прислали e-mail: {update.message.text}'
-        update.message.delete()
-        update.message.reply_text(text=message, reply_markup=reply_markup)
-    else:
-        message = 'Пожалуйста сообщите свой e-mail для формирования заказа'
-        query = update.callback_query
-
-        if '/create_customer' in query.data:
-            username = query.message.from_user['username']
-            email = str(query.data).split('>')[1]
-            customer = create_a_customer(
-                context.bot_data['api_base_url'],
-                context.bot_data['client_id'],
-                context.bot_data['client_secret'],
-                username,
-                email
-            )['data']
-            message = f'''\
-            Покупатель: {customer['name']}
-            E-mail: {customer['email']}
-            ID: {customer['id']}
-            '''
-            query.message.delete()
-
-        elif '/wrong_email' in query.data:
-            query.message.delete()
-
-        query.message.reply_text(text=dedent(message))
-        query.answer()
+    message = f'Вы прислали e-mail: {update.message.text}'
+    update.message.delete()
+    update.message.reply_text(text=message, reply_markup=reply_markup)
+
+    return 'WAITING_EMAIL'
+
+
+def handle_email_request(update, context):
+    """Запрос email покупателя для формирования заказа"""
+
+    query = update.callback_query
+    message = 'Пожалуйста сообщите свой e-mail для формирования заказа'
+    query.message.reply_text(text=message)
+    query.answer()
 
     return 'WAITING_EMAIL'
 
 
+def handle_wrong_email(update, context):
+    """Повторный запрос email, если пользователь ошибся"""
+
+    update.callback_query.message.delete()
+    return handle_email_request(update, context)
+
+
+def handle_customer(update, context, email):
+    """Функция, которая создает пользователя на основе полученного email"""
+
+    query = update.callback_query
+    username = query.message.from_user['username']
+    customer = create_a_customer(
+        context.bot_data['api_base_url'],
+        context.bot_data['client_id'],
+        context.bot_data['client_secret'],
+        username,
+        email
+    )['data']
+    message = f'''\
+    Покупатель: {customer['name']}
+    E-mail: {customer['email']}
+    ID: {customer['id']}
+    '''
+    query.message.delete()
+
+    query.message.reply_text(text=dedent(message))
+    query.answer()
+
+    return 'WAITING_EMAIL'
+
+
+STATE_MACHINE = compile_states({
+    'START': {
+        'default': start,
+        'transitions': {'HANDLE_MENU'},
+    },
+    'HANDLE_MENU': {
+        'routes': {PRODUCT: handle_menu, CART: handle_cart},
+        'default': start,
+        'transitions': {'HANDLE_MENU', 'HANDLE_DESCRIPTION', 'HANDLE_CART'},
+    },
+    'HANDLE_DESCRIPTION': {
+        'routes': {ADD: handle_description, MENU: start, CART: handle_cart},
+        'default': start,
+        'transitions': {'HANDLE_MENU', 'HANDLE_DESCRIPTION', 'HANDLE_CART'},
+    },
+    'HANDLE_CART': {
+        'routes': {
+            MENU: start,
+            DELETE: handle_cart,
+            PAY: handle_email_request,
+        },
+        'default': start,
+        'transitions': {'HANDLE_MENU', 'HANDLE_CART', 'WAITING_EMAIL'},
+    },
+    'WAITING_EMAIL': {
+        'routes': {
+            MESSAGE_ACTION: handle_email,
+            CUSTOMER: handle_customer,
+            WRONG_EMAIL: handle_wrong_email,
+        },
+        'default': handle_email_request,
+        'transitions': {'WAITING_EMAIL'},
+    },
+})
+
+
 def handle_users_reply(
         update,
         context,
@@ -300,8 +415,8 @@ def handle_users_reply(
         * Нажатие на inline-кнопку в боте
         * Отправка сообщения боту
         * Отправка команды боту
-    Она получает стейт пользователя из базы данных и запускает соответствующую
-     функцию-обработчик (хэндлер).
+    Она получает стейт пользователя из базы данных и по таблице STATE_MACHINE
+     запускает соответствующую функцию-обработчик (хэндлер).
     Функция-обработчик возвращает следующее состояние, которое записывается
      в базу данных.
     Если пользователь только начал пользоваться ботом, Telegram форсит его
@@ -324,16 +439,7 @@ def handle_users_reply(
     else:
         user_state = db_connection.get(chat_id).decode("utf-8")
 
-    states_functions = {
-        'START': start,
-        'HANDLE_MENU': handle_menu,
-        'HANDLE_DESCRIPTION': handle_description,
-        'HANDLE_CART': handle_cart,
-        'WAITING_EMAIL': handle_email,
-    }
-    state_handler = states_functions[user_state]
-
-    next_state = state_handler(update, context)
+    next_state = dispatch(STATE_MACHINE, user_state, update, context)
 
     db_connection.set(chat_id, next_state)
 
@@ -362,6 +468,7 @@ if __name__ == '__main__':
     dispatcher.bot_data['api_base_url'] = api_base_url
     dispatcher.bot_data['client_id'] = client_id
     dispatcher.bot_data['client_secret'] = client_secret
+    dispatcher.bot_data['db_connection'] = db_connection
 
     dispatcher.add_handler(
         CallbackQueryHandler(partial_handle_users_reply)
@@ -373,5 +480,18 @@ if __name__ == '__main__':
         CommandHandler('start', partial_handle_users_reply)
     )
     dispatcher.add_error_handler(_error)
+    updater.job_queue.run_repeating(
+        _check_moltin,
+        interval=RECOVERY_CHECK_INTERVAL
+    )
+    updater.job_queue.run_repeating(
+        _refresh_snapshot,
+        interval=SNAPSHOT_REFRESH_INTERVAL,
+        first=1
+    )
+    updater.job_queue.run_repeating(
+        _log_coalescing_stats,
+        interval=STATS_LOG_INTERVAL
+    )
     updater.start_polling()
     updater.idle()
@@ -0,0 +1,382 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from moltin_api import create_a_product
+from moltin_api import create_main_image_relationship
+from moltin_api import get_products
+from moltin_api import load_environment
+from moltin_api import update_a_product
+from moltin_api import upload_a_file
+
+MANIFEST_FIELDS = [
+    'sku',
+    'name',
+    'slug',
+    'description',
+    'price',
+    'currency',
+    'status',
+    'image',
+    'image_id',
+]
+COMPARED_FIELDS = [
+    'name',
+    'slug',
+    'description',
+    'price',
+    'currency',
+    'status',
+]
+PAGE_LIMIT = 100
+
+
+def read_manifest(manifest_path):
+    """
+    Читает манифест каталога в формате CSV или JSON (список объектов).
+    Формат определяется по расширению файла, sku товаров не должны повторяться.
+    Возвращает список товаров с полями MANIFEST_FIELDS
+    """
+    with open(manifest_path, encoding='utf-8') as manifest:
+        if manifest_path.endswith('.json'):
+            rows = json.load(manifest)
+        else:
+            rows = list(csv.DictReader(manifest))
+
+    products = []
+    skus = set()
+    for row in rows:
+        product = {field: row.get(field) or '' for field in MANIFEST_FIELDS}
+        if not product['sku']:
+            raise ValueError(f'В манифесте есть товар без sku: {row}')
+        if product['sku'] in skus:
+            raise ValueError(f"В манифесте повторяется sku: {product['sku']}")
+        skus.add(product['sku'])
+        product['price'] = int(product['price'] or 0)
+        product['currency'] = product['currency'] or 'RUB'
+        product['status'] = product['status'] or 'live'
+        products.append(product)
+    return products
+
+
+def iterate_live_products(api_base_url, client_id, client_secret):
+    """Постранично обходит каталог и по одному отдает товары"""
+    offset = 0
+    while True:
+        page = get_products(
+            api_base_url,
+            client_id,
+            client_secret,
+            offset=offset,
+            limit=PAGE_LIMIT
+        )
+        yield from page['data']
+        if len(page['data']) < PAGE_LIMIT:
+            return
+        offset += PAGE_LIMIT
+
+
+def to_manifest_row(live_product):
+    """Приводит товар из API к строке манифеста"""
+    price = (live_product.get('price') or [{}])[0]
+    main_image = live_product.get('relationships', {}).get('main_image', {})
+    return {
+        'sku': live_product.get('sku', ''),
+        'name': live_product.get('name', ''),
+        'slug': live_product.get('slug', ''),
+        'description': live_product.get('description', ''),
+        'price': price.get('amount', 0),
+        'currency': price.get('currency', ''),
+        'status': live_product.get('status', ''),
+        'image': '',
+        'image_id': (main_image.get('data') or {}).get('id', ''),
+    }
+
+
+def to_product_attributes(product):
+    """Приводит строку манифеста к атрибутам товара для API"""
+    return {
+        'name': product['name'],
+        'slug': product['slug'],
+        'sku': product['sku'],
+        'description': product['description'],
+        'manage_stock': False,
+        'price': [
+            {
+                'amount': product['price'],
+                'currency': product['currency'],
+                'includes_tax': True,
+            }
+        ],
+        'status': product['status'],
+        'commodity_type': 'physical',
+    }
+
+
+def plan_changes(products, live_products):
+    """
+    Сравнивает манифест с каталогом.
+    Возвращает список (действие, товар из манифеста, товар из каталога,
+     изменившиеся поля), где действие: create, update или skip
+    """
+    live_by_sku = {}
+    for live_product in live_products:
+        if not live_product.get('sku'):
+            logging.warning(
+                f"Товар {live_product.get('id')} в каталоге без sku, "
+                f"пропускаем"
+            )
+            continue
+        live_by_sku[live_product['sku']] = live_product
+    changes = []
+    for product in products:
+        live_product = live_by_sku.get(product['sku'])
+        if not live_product:
+            changed_fields = list(COMPARED_FIELDS)
+            if product['image'] or product['image_id']:
+                changed_fields.append('image')
+            changes.append(('create', product, None, changed_fields))
+            continue
+
+        live_row = to_manifest_row(live_product)
+        changed_fields = [
+            field for field in COMPARED_FIELDS
+            if str(product[field]) != str(live_row[field])
+        ]
+        if needs_image(product, live_row):
+            changed_fields.append('image')
+        action = 'update' if changed_fields else 'skip'
+        changes.append((action, product, live_product, changed_fields))
+    return changes
+
+
+def needs_image(product, live_row):
+    """
+    Нужно ли загружать или перепривязывать главную картинку товара.
+    Файл из поля image загружается, только если у товара еще нет картинки.
+    Чтобы заменить картинку, укажите image_id уже загруженного файла
+    """
+    if product['image_id']:
+        return product['image_id'] != live_row['image_id']
+    return bool(product['image']) and not live_row['image_id']
+
+
+def print_diff(changes):
+    """Выводит разницу между манифестом и каталогом"""
+    for action, product, live_product, changed_fields in changes:
+        if action == 'create':
+            print(f"+ {product['sku']}: {product['name']}")
+        elif action == 'update':
+            live_row = to_manifest_row(live_product)
+            print(f"~ {product['sku']}:")
+            for field in changed_fields:
+                if field == 'image':
+                    new_image = product['image_id'] or product['image']
+                    print(f"    image: {live_row['image_id']!r} -> "
+                          f"{new_image!r}")
+                    continue
+                print(f'    {field}: {live_row[field]!r} -> '
+                      f'{product[field]!r}')
+        else:
+            print(f"= {product['sku']}")
+
+
+def apply_change(
+        api_base_url,
+        client_id,
+        client_secret,
+        change,
+        images_folder
+):
+    """Создает или обновляет товар и привязывает к нему главную картинку"""
+    action, product, live_product, changed_fields = change
+    if action == 'skip':
+        return action, product['sku']
+
+    attributes = to_product_attributes(product)
+    if action == 'create':
+        product_id = create_a_product(
+            api_base_url,
+            client_id,
+            client_secret,
+            attributes
+        )['data']['id']
+    else:
+        product_id = live_product['id']
+        update_a_product(
+            api_base_url,
+            client_id,
+            client_secret,
+            product_id,
+            attributes
+        )
+
+    if 'image' not in changed_fields:
+        return action, product['sku']
+
+    image_id = product['image_id']
+    if not image_id and product['image']:
+        image_id = upload_a_file(
+            api_base_url,
+            client_id,
+            client_secret,
+            os.path.join(images_folder, product['image'])
+        )['data']['id']
+    if image_id:
+        create_main_image_relationship(
+            api_base_url,
+            client_id,
+            client_secret,
+            product_id,
+            image_id
+        )
+    return action, product['sku']
+
+
+def import_catalog(args):
+    api_base_url, client_id, client_secret = load_environment()
+    products = read_manifest(args.manifest)
+    live_products = iterate_live_products(
+        api_base_url,
+        client_id,
+        client_secret
+    )
+    changes = plan_changes(products, live_products)
+
+    if args.dry_run:
+        print_diff(changes)
+        return
+
+    started_at = time.monotonic()
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(
+                apply_change,
+                api_base_url,
+                client_id,
+                client_secret,
+                change,
+                args.images
+            ): change[1]['sku']
+            for change in changes
+        }
+        for future in as_completed(futures):
+            try:
+                action, sku = future.result()
+            except Exception:
+                failed += 1
+                logging.exception(
+                    f'Не удалось загрузить товар {futures[future]}'
+                )
+                continue
+            logging.info(f'{action}: {sku}')
+
+    elapsed = time.monotonic() - started_at
+    logging.info(
+        f'Обработано {len(changes)} товаров (ошибок: {failed}) '
+        f'за {elapsed:.2f} с, '
+        f'{len(changes) / max(elapsed, 1e-9):.1f} товаров/с'
+    )
+    if failed:
+        sys.exit(1)
+
+
+def export_catalog(args):
+    api_base_url, client_id, client_secret = load_environment()
+    if args.output == '-':
+        output = sys.stdout
+    else:
+        output = open(args.output, 'w', encoding='utf-8', newline='')
+
+    started_at = time.monotonic()
+    exported = 0
+    rows = map(
+        to_manifest_row,
+        iterate_live_products(api_base_url, client_id, client_secret)
+    )
+    try:
+        if args.format == 'json':
+            output.write('[')
+            for row in rows:
+                output.write(',\n' if exported else '\n')
+                output.write(json.dumps(row, ensure_ascii=False))
+                exported += 1
+            output.write('\n]\n')
+        else:
+            writer = csv.DictWriter(output, fieldnames=MANIFEST_FIELDS)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                exported += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    elapsed = time.monotonic() - started_at
+    logging.info(
+        f'Выгружено {exported} товаров за {elapsed:.2f} с, '
+        f'{exported / max(elapsed, 1e-9):.1f} товаров/с'
+    )
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Массовая загрузка и выгрузка каталога Elastic Path'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser(
+        'import',
+        help='Создать или обновить товары по манифесту CSV/JSON'
+    )
+    import_parser.add_argument('manifest', help='Путь к манифесту')
+    import_parser.add_argument(
+        '--images',
+        default='images',
+        help='Папка с картинками товаров (по умолчанию images)'
+    )
+    import_parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='Количество параллельных запросов к API (по умолчанию 4)'
+    )
+    import_parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Только показать разницу с каталогом, ничего не меняя'
+    )
+    import_parser.set_defaults(handler=import_catalog)
+
+    export_parser = subparsers.add_parser(
+        'export',
+        help='Выгрузить каталог в формате манифеста'
+    )
+    export_parser.add_argument(
+        'output',
+        nargs='?',
+        default='-',
+        help='Файл для выгрузки (по умолчанию stdout)'
+    )
+    export_parser.add_argument(
+        '--format',
+        choices=['csv', 'json'],
+        default='csv',
+        help='Формат выгрузки (по умолчанию csv)'
+    )
+    export_parser.set_defaults(handler=export_catalog)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
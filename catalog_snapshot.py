@@ -0,0 +1,334 @@
+import json
+import logging
+import requests
+import threading
+import time
+
+from moltin_api import add_product_to_cart
+from moltin_api import get_files
+from moltin_api import get_products
+from moltin_api import get_token
+from moltin_api import remove_item_from_cart
+
+ERRORS_THRESHOLD = 3
+LATENCY_THRESHOLD = 2
+RECOVERY_CHECK_INTERVAL = 30
+SNAPSHOT_REFRESH_INTERVAL = 600
+
+SNAPSHOT_PREFIX = 'snapshot'
+CART_QUEUE_KEY = f'{SNAPSHOT_PREFIX}:cart_queue'
+CART_DEAD_LETTER_KEY = f'{SNAPSHOT_PREFIX}:cart_dead_letter'
+
+DEGRADED = False
+CONSECUTIVE_FAILURES = 0
+LAST_UPSTREAM_CHECK = 0
+
+_lock = threading.Lock()
+_replay_lock = threading.Lock()
+_snapshot_lock = threading.Lock()
+_saved_snapshots = {}
+
+
+def is_degraded():
+    """Работает ли бот в режиме только чтения из снимка каталога"""
+    return DEGRADED
+
+
+def should_call_upstream():
+    """
+    В обычном режиме всегда обращаемся к Moltin.
+    В режиме деградации пропускаем к Moltin не чаще одного запроса
+     в RECOVERY_CHECK_INTERVAL секунд, чтобы понять, восстановился ли он
+    """
+    global LAST_UPSTREAM_CHECK
+
+    with _lock:
+        if not DEGRADED:
+            return True
+        current_time = time.monotonic()
+        if current_time - LAST_UPSTREAM_CHECK < RECOVERY_CHECK_INTERVAL:
+            return False
+        LAST_UPSTREAM_CHECK = current_time
+        return True
+
+
+def register_upstream_call(succeeded, elapsed):
+    """
+    Учитывает результат запроса к Moltin и переключает режим работы.
+    Ошибка или слишком медленный ответ считаются сбоем
+    """
+    global CONSECUTIVE_FAILURES
+    global DEGRADED
+    global LAST_UPSTREAM_CHECK
+
+    with _lock:
+        if succeeded and elapsed <= LATENCY_THRESHOLD:
+            if DEGRADED:
+                logging.info('Moltin is back. Leaving degraded mode.')
+            CONSECUTIVE_FAILURES = 0
+            DEGRADED = False
+            return
+
+        CONSECUTIVE_FAILURES += 1
+        if not DEGRADED and CONSECUTIVE_FAILURES >= ERRORS_THRESHOLD:
+            logging.warning(
+                'Moltin is failing or too slow. Switching to degraded mode.'
+            )
+            DEGRADED = True
+            LAST_UPSTREAM_CHECK = time.monotonic()
+
+
+def is_upstream_failure(error):
+    """
+    Сбой ли это Moltin: таймаут, ошибка соединения или ответ 5xx.
+    Ответы 4xx означают, что Moltin работает, а ошибка в самом запросе
+    """
+    if isinstance(error, (requests.Timeout, requests.ConnectionError)):
+        return True
+    if isinstance(error, requests.HTTPError):
+        response = error.response
+        return response is None or response.status_code >= 500
+    return False
+
+
+def without_retry(function):
+    """
+    Метод Moltin API без декоратора @retry.
+    Нужен там, где есть запасной вариант: снимок или очередь действий
+    """
+    return getattr(function, '__wrapped__', function)
+
+
+def _call_moltin(function, bot_data, *args, **kwargs):
+    """
+    Вызывает метод Moltin API без @retry.
+    Токен запрашивается заранее, тоже без @retry, чтобы метод взял его
+     из кэша и не ждал повторных попыток внутри get_token
+    """
+    credentials = (
+        bot_data['api_base_url'],
+        bot_data['client_id'],
+        bot_data['client_secret'],
+    )
+    without_retry(get_token)(*credentials)
+    return without_retry(function)(*credentials, *args, **kwargs)
+
+
+def call_upstream(function, *args, **kwargs):
+    """Вызывает метод Moltin API, замеряя время ответа и учитывая ошибки"""
+    started_at = time.monotonic()
+    try:
+        result = function(*args, **kwargs)
+    except Exception as error:
+        register_upstream_call(
+            not is_upstream_failure(error),
+            time.monotonic() - started_at
+        )
+        raise
+    register_upstream_call(True, time.monotonic() - started_at)
+    return result
+
+
+def _save_snapshot(db_connection, snapshot_key, value):
+    """
+    Записывает значение в снимок, только если оно изменилось или
+     записано больше SNAPSHOT_REFRESH_INTERVAL секунд назад
+    """
+    current_time = time.monotonic()
+    with _snapshot_lock:
+        saved_value, saved_at = _saved_snapshots.get(snapshot_key, (None, 0))
+        if (saved_value == value
+                and current_time - saved_at < SNAPSHOT_REFRESH_INTERVAL):
+            return
+        _saved_snapshots[snapshot_key] = (value, current_time)
+    db_connection.set(snapshot_key, value)
+
+
+def _fetch(bot_data, snapshot_key, function, on_fetched=None, **kwargs):
+    """
+    Возвращает ответ Moltin и обновляет по нему снимок.
+    on_fetched вызывается только для свежего ответа Moltin.
+    Если Moltin недоступен или бот в режиме деградации, отдает снимок
+    """
+    db_connection = bot_data['db_connection']
+    if should_call_upstream():
+        try:
+            result = call_upstream(_call_moltin, function, bot_data, **kwargs)
+        except Exception:
+            logging.exception(f'Moltin request failed, using {snapshot_key}')
+        else:
+            _save_snapshot(db_connection, snapshot_key, json.dumps(result))
+            if on_fetched:
+                on_fetched(result)
+            return result
+
+    snapshot = db_connection.get(snapshot_key)
+    if snapshot is None:
+        raise LookupError(f'No snapshot for {snapshot_key}')
+    return json.loads(snapshot)
+
+
+def fetch_products(bot_data, product_id=None):
+    """
+    get_products с запасным вариантом из снимка каталога.
+    Список товаров содержит полные описания, поэтому вместе с ним
+     в снимок записывается и каждый товар
+    """
+    snapshot_key = f'{SNAPSHOT_PREFIX}:products'
+    if product_id:
+        return _fetch(
+            bot_data,
+            f'{snapshot_key}:{product_id}',
+            get_products,
+            product_id=product_id
+        )
+
+    def save_products(products):
+        for product in products['data']:
+            _save_snapshot(
+                bot_data['db_connection'],
+                f"{snapshot_key}:{product['id']}",
+                json.dumps({'data': product})
+            )
+
+    return _fetch(bot_data, snapshot_key, get_products, save_products)
+
+
+def fetch_file(bot_data, file_id):
+    """get_files с запасным вариантом из снимка каталога"""
+    return _fetch(
+        bot_data,
+        f'{SNAPSHOT_PREFIX}:files:{file_id}',
+        get_files,
+        file_id=file_id
+    )
+
+
+def refresh_snapshot(bot_data):
+    """
+    Заполняет снимок целиком: список товаров, каждый товар и описания
+     их главных картинок, чтобы в режиме деградации открывались и те
+     товары, которые еще никто не смотрел
+    """
+    if DEGRADED:
+        return
+    try:
+        products = fetch_products(bot_data)
+        for product in products['data']:
+            main_image = product.get('relationships', {}).get('main_image')
+            if main_image:
+                fetch_file(bot_data, main_image['data']['id'])
+    except Exception:
+        logging.exception('Failed to refresh catalog snapshot')
+
+
+def check_upstream(bot_data):
+    """
+    В режиме деградации раз в RECOVERY_CHECK_INTERVAL секунд проверяет
+     Moltin легким запросом, даже если пользователи ничего не запрашивают
+    """
+    if not DEGRADED or not should_call_upstream():
+        return
+    try:
+        call_upstream(_call_moltin, get_products, bot_data, limit=1)
+    except Exception:
+        logging.exception('Moltin is still unavailable')
+
+
+def get_photo_id(bot_data, product_id):
+    """Возвращает сохраненный Telegram file_id картинки товара"""
+    photo_id = bot_data['db_connection'].get(
+        f'{SNAPSHOT_PREFIX}:photos:{product_id}'
+    )
+    return photo_id.decode('utf-8') if photo_id else None
+
+
+def save_photo_id(bot_data, product_id, photo_id):
+    """Запоминает Telegram file_id картинки товара"""
+    _save_snapshot(
+        bot_data['db_connection'],
+        f'{SNAPSHOT_PREFIX}:photos:{product_id}',
+        photo_id
+    )
+
+
+def _change_cart(bot_data, cart_action):
+    if cart_action['action'] == 'add':
+        _call_moltin(
+            add_product_to_cart,
+            bot_data,
+            cart_action['chat_id'],
+            cart_action['product_id'],
+            cart_action['quantity']
+        )
+    else:
+        _call_moltin(
+            remove_item_from_cart,
+            bot_data,
+            cart_action['chat_id'],
+            cart_action['product_id']
+        )
+
+
+def change_cart(bot_data, action, chat_id, product_id, quantity=None):
+    """
+    Добавляет (action='add') или удаляет (action='remove') товар в корзине.
+    Если Moltin недоступен или в очереди уже есть действия, ставит действие
+     в очередь, чтобы действия выполнялись в порядке поступления.
+    Ошибки 4xx не откладываются, а пробрасываются дальше.
+    Возвращает True, если корзина изменена сразу, и False, если действие
+     отложено
+    """
+    db_connection = bot_data['db_connection']
+    cart_action = {
+        'action': action,
+        'chat_id': chat_id,
+        'product_id': product_id,
+        'quantity': quantity,
+    }
+    if not db_connection.llen(CART_QUEUE_KEY) and should_call_upstream():
+        try:
+            call_upstream(_change_cart, bot_data, cart_action)
+            return True
+        except Exception as error:
+            if not is_upstream_failure(error):
+                raise
+            logging.exception('Moltin request failed, queueing cart action')
+
+    db_connection.rpush(CART_QUEUE_KEY, json.dumps(cart_action))
+    return False
+
+
+def replay_cart_actions(bot_data):
+    """
+    Выполняет отложенные действия с корзинами после восстановления Moltin.
+    При сбое Moltin оставляет действие в начале очереди и прекращает работу,
+     а действие с ошибкой 4xx переносит в CART_DEAD_LETTER_KEY
+    """
+    if DEGRADED:
+        return
+    if not _replay_lock.acquire(blocking=False):
+        return
+    try:
+        _replay_queue(bot_data)
+    finally:
+        _replay_lock.release()
+
+
+def _replay_queue(bot_data):
+    db_connection = bot_data['db_connection']
+    while True:
+        # Действие снимается с очереди только после выполнения: пока оно
+        # выполняется, новые действия тоже встают в очередь, а не обгоняют его
+        queued_action = db_connection.lindex(CART_QUEUE_KEY, 0)
+        if queued_action is None:
+            return
+        try:
+            call_upstream(_change_cart, bot_data, json.loads(queued_action))
+        except Exception as error:
+            if is_upstream_failure(error):
+                logging.exception('Failed to replay queued cart action')
+                return
+            logging.exception('Queued cart action rejected, dropping it')
+            db_connection.rpush(CART_DEAD_LETTER_KEY, queued_action)
+        db_connection.lpop(CART_QUEUE_KEY)
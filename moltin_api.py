@@ -1,13 +1,20 @@
 import json
 import os
 import requests
+import threading
 import time
 
+from concurrent.futures import Future
 from dotenv import load_dotenv
 from funcy import retry
 
 MOLTIN_TOKEN = None
 MOLTIN_TOKEN_EXPIRES_TIME = 0
+REQUEST_TIMEOUT = 5
+
+COALESCING_STATS = {'requests': 0, 'collapsed': 0}
+_in_flight_requests = {}
+_in_flight_lock = threading.Lock()
 
 
 @retry(tries=3, timeout=1)
@@ -46,12 +53,57 @@ def add_product_to_cart(
     response = requests.post(
         f'{api_base_url}/v2/carts/{cart_id}/items',
         headers=headers,
-        data=json.dumps(data)
+        data=json.dumps(data),
+        timeout=REQUEST_TIMEOUT
     )
     response.raise_for_status()
     return response.json()
 
 
+def coalesced_get(url, headers, params=None):
+    """
+    GET-запрос к API, объединяющий одинаковые одновременные запросы.
+    Пока запрос к url с такими же params выполняется, остальные потоки
+     не отправляют свой запрос, а дожидаются его и получают тот же JSON
+     (или ту же ошибку). Счетчики запросов в COALESCING_STATS.
+    Все ожидающие получают один и тот же объект, поэтому изменять
+     результат нельзя: скопируйте его, если это нужно
+    """
+    key = (url, tuple(sorted((params or {}).items())))
+    with _in_flight_lock:
+        COALESCING_STATS['requests'] += 1
+        future = _in_flight_requests.get(key)
+        if future:
+            COALESCING_STATS['collapsed'] += 1
+            is_leader = False
+        else:
+            future = Future()
+            _in_flight_requests[key] = future
+            is_leader = True
+
+    if not is_leader:
+        return future.result()
+
+    try:
+        response = requests.get(
+            url,
+            headers=headers,
+            params=params,
+            timeout=REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+        result = response.json()
+    except BaseException as error:
+        future.set_exception(error)
+        raise
+    else:
+        future.set_result(result)
+    finally:
+        with _in_flight_lock:
+            del _in_flight_requests[key]
+    return result
+
+
 @retry(tries=3, timeout=1)
 def create_a_file(
         api_base_url,
@@ -86,7 +138,8 @@ def create_a_file(
         response = requests.post(
             f'{api_base_url}/v2/files',
             headers=headers,
-            files=files
+            files=files,
+            timeout=REQUEST_TIMEOUT
         )
         response.raise_for_status()
 
@@ -136,7 +189,41 @@ def create_a_customer(
     response = requests.post(
         f'{api_base_url}/v2/customers',
         headers=headers,
-        data=json.dumps(data)
+        data=json.dumps(data),
+        timeout=REQUEST_TIMEOUT
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def create_a_product(
+        api_base_url,
+        client_id,
+        client_secret,
+        product
+):
+    """
+    Создает товар.
+    Без @retry: если товар создан, а ответ не дошел, повтор создал бы дубль
+    :param product: Словарь атрибутов товара (name, slug, sku, price и т.д.)
+    :return: Результат (в т.ч. ошибку) как JSON объект
+    """
+    token = get_token(
+        api_base_url,
+        client_id,
+        client_secret
+    )
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json',
+    }
+    data = {"data": {"type": "product", **product}}
+
+    response = requests.post(
+        f'{api_base_url}/v2/products',
+        headers=headers,
+        data=json.dumps(data),
+        timeout=REQUEST_TIMEOUT
     )
     response.raise_for_status()
     return response.json()
@@ -169,7 +256,8 @@ def create_main_image_relationship(
     response = requests.post(
         f'{api_base_url}/v2/products/{product_id}/relationships/main-image',
         headers=headers,
-        data=json.dumps(data)
+        data=json.dumps(data),
+        timeout=REQUEST_TIMEOUT
     )
     response.raise_for_status()
     return response.json()
@@ -199,7 +287,8 @@ def get_token(
     }
     response = requests.post(
         f'{api_base_url}/oauth/access_token',
-        data=data
+        data=data,
+        timeout=REQUEST_TIMEOUT
     )
     response.raise_for_status()
     token_info = response.json()
@@ -231,10 +320,7 @@ def get_a_customers(
     if customer_id:
         url += customer_id
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-
-    return response.json()
+    return coalesced_get(url, headers)
 
 
 @retry(tries=3, timeout=1)
@@ -258,10 +344,7 @@ def get_files(
     if file_id:
         url += file_id
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-
-    return response.json()
+    return coalesced_get(url, headers)
 
 
 @retry(tries=3, timeout=1)
@@ -273,7 +356,9 @@ def get_cart_status(
         items=False
 ):
     """
-    Возвращает статус корзины или ее список товаров в ней
+    Возвращает статус корзины или ее список товаров в ней.
+    Запрос не объединяется с одновременными: корзину читают сразу после
+     ее изменения, и уже выполняющийся запрос мог вернуть старое состояние
     """
     token = get_token(
         api_base_url,
@@ -286,7 +371,11 @@ def get_cart_status(
     if items:
         url += '/items'
 
-    response = requests.get(url, headers=headers)
+    response = requests.get(
+        url,
+        headers=headers,
+        timeout=REQUEST_TIMEOUT
+    )
     response.raise_for_status()
 
     return response.json()
@@ -297,11 +386,14 @@ def get_products(
         api_base_url,
         client_id,
         client_secret,
-        product_id=None
+        product_id=None,
+        offset=None,
+        limit=None
 ):
     """
     Возвращает описание всех продуктов
-    или описание конкретного продукта по его ID
+    или описание конкретного продукта по его ID.
+    Для списка продуктов можно указать страницу: offset и limit
     """
     token = get_token(
         api_base_url,
@@ -311,13 +403,16 @@ def get_products(
     headers = {'Authorization': f'Bearer {token}'}
 
     url = f'{api_base_url}/v2/products/'
+    params = {}
     if product_id:
         url += product_id
+    else:
+        if offset is not None:
+            params['page[offset]'] = offset
+        if limit is not None:
+            params['page[limit]'] = limit
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-
-    return response.json()
+    return coalesced_get(url, headers, params)
 
 
 @retry(tries=3, timeout=1)
@@ -341,12 +436,93 @@ def remove_item_from_cart(
 
     url = f'{api_base_url}/v2/carts/{card_id}/items/{product_id}'
 
-    response = requests.delete(url, headers=headers)
+    response = requests.delete(
+        url,
+        headers=headers,
+        timeout=REQUEST_TIMEOUT
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+@retry(tries=3, timeout=1)
+def update_a_product(
+        api_base_url,
+        client_id,
+        client_secret,
+        product_id,
+        product
+):
+    """
+    Обновляет атрибуты существующего товара по его ID
+    :param product: Словарь изменяемых атрибутов товара
+    :return: Результат (в т.ч. ошибку) как JSON объект
+    """
+    token = get_token(
+        api_base_url,
+        client_id,
+        client_secret
+    )
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json',
+    }
+    data = {"data": {"type": "product", "id": product_id, **product}}
+
+    response = requests.put(
+        f'{api_base_url}/v2/products/{product_id}',
+        headers=headers,
+        data=json.dumps(data),
+        timeout=REQUEST_TIMEOUT
+    )
     response.raise_for_status()
+    return response.json()
+
+
+@retry(tries=3, timeout=1)
+def upload_a_file(
+        api_base_url,
+        client_id,
+        client_secret,
+        filename_path
+):
+    """
+    Загружает один файл в систему CMS как публичный.
+    В отличие от create_a_file не переименовывает исходный файл
+    :return: Результат (в т.ч. ошибку) как JSON объект
+    """
+    token = get_token(
+        api_base_url,
+        client_id,
+        client_secret
+    )
+    headers = {'Authorization': f'Bearer {token}'}
 
+    with open(filename_path, 'rb') as file:
+        files = {
+            'file': (os.path.basename(filename_path), file),
+            'public': (None, 'true'),
+        }
+        response = requests.post(
+            f'{api_base_url}/v2/files',
+            headers=headers,
+            files=files,
+            timeout=REQUEST_TIMEOUT
+        )
+    response.raise_for_status()
     return response.json()
 
 
+def get_coalescing_stats():
+    """
+    Возвращает количество GET-запросов к API и сколько из них
+     было объединено с уже выполняющимся таким же запросом
+    """
+    with _in_flight_lock:
+        return dict(COALESCING_STATS)
+
+
 def load_environment():
     load_dotenv()
     api_base_url = os.environ.get('API_BASE_URL', 'https://api.moltin.com')
@@ -0,0 +1,144 @@
+import inspect
+import logging
+import time
+
+CALLBACK_VERSION = '1'
+CALLBACK_SEPARATOR = '|'
+CALLBACK_MAX_BYTES = 64
+MESSAGE_ACTION = 'message'
+
+
+def encode_callback(action, *args):
+    """
+    Кодирует действие и его аргументы в callback_data кнопки:
+     версия|действие|аргумент|...
+    Telegram ограничивает callback_data 64 байтами
+    """
+    callback_data = CALLBACK_SEPARATOR.join(
+        [CALLBACK_VERSION, action, *map(str, args)]
+    )
+    if len(callback_data.encode('utf-8')) > CALLBACK_MAX_BYTES:
+        raise ValueError(f'Callback data is too long: {callback_data}')
+    return callback_data
+
+
+def decode_callback(callback_data):
+    """
+    Раскодирует callback_data в действие и строку его аргументов.
+    Для кнопок старого формата или другой версии возвращает (None, '')
+    """
+    version, _, payload = callback_data.partition(CALLBACK_SEPARATOR)
+    if version != CALLBACK_VERSION or not payload:
+        return None, ''
+    action, _, arguments = payload.partition(CALLBACK_SEPARATOR)
+    return action, arguments
+
+
+def split_arguments(arguments, arguments_count):
+    """
+    Делит строку аргументов не больше чем на arguments_count частей,
+     чтобы разделитель в последнем аргументе (например, в email
+     пользователя) не превращался в лишний аргумент
+    """
+    if not arguments or not arguments_count:
+        return ()
+    return tuple(
+        arguments.split(CALLBACK_SEPARATOR, arguments_count - 1)
+    )
+
+
+def count_arguments(handler):
+    """Сколько аргументов хэндлер принимает помимо update и context"""
+    return len(inspect.signature(handler).parameters) - 2
+
+
+def log_transition(state, action, next_state, elapsed):
+    """Хук по умолчанию: пишет время обработки перехода в лог"""
+    logging.debug(
+        f'{state} -({action})-> {next_state}: {elapsed * 1000:.1f} ms'
+    )
+
+
+def compile_states(states):
+    """
+    Проверяет описание состояний и собирает из него таблицу маршрутов.
+    Описание состояния - словарь с ключами:
+        * routes - {действие: хэндлер}, для текстовых сообщений
+           действие MESSAGE_ACTION
+        * default - хэндлер для неизвестных действий (необязательно)
+        * transitions - состояния, в которые можно перейти
+    Возвращает {состояние: (routes, default, transitions)}, где routes -
+     {действие: (хэндлер, количество его аргументов)}
+    """
+    state_machine = {}
+    for state, description in states.items():
+        routes = dict(description.get('routes', {}))
+        default_handler = description.get('default')
+        transitions = frozenset(description['transitions'])
+
+        unknown_states = transitions - states.keys()
+        if unknown_states:
+            raise ValueError(
+                f'State {state} has transitions to unknown states: '
+                f'{sorted(unknown_states)}'
+            )
+        handlers = [*routes.values(), default_handler]
+        if not routes and default_handler is None:
+            raise ValueError(f'State {state} has no handlers')
+        if not all(h is None or callable(h) for h in handlers):
+            raise ValueError(f'State {state} has not callable handler')
+
+        routes = {
+            action: (handler, count_arguments(handler))
+            for action, handler in routes.items()
+        }
+        state_machine[state] = (routes, default_handler, transitions)
+    return state_machine
+
+
+def dispatch(
+        state_machine,
+        state,
+        update,
+        context,
+        timing_hook=log_transition
+):
+    """
+    Находит хэндлер для действия пользователя в текущем состоянии,
+     запускает его и проверяет, что переход в новое состояние разрешен.
+    Хэндлер к этому моменту уже отработал, поэтому недопустимый переход
+     не отменить: он пишется в лог, а пользователь остается в текущем
+     состоянии.
+    Возвращает новое состояние
+    """
+    routes, default_handler, transitions = state_machine[state]
+
+    if update.callback_query:
+        action, arguments = decode_callback(update.callback_query.data)
+    else:
+        action, arguments = MESSAGE_ACTION, ''
+
+    if action in routes:
+        handler, arguments_count = routes[action]
+        args = split_arguments(arguments, arguments_count)
+    elif default_handler is not None:
+        handler, args = default_handler, ()
+    else:
+        raise KeyError(f'State {state} has no route for {action}')
+
+    next_state = None
+    started_at = time.perf_counter()
+    try:
+        next_state = handler(update, context, *args)
+    finally:
+        timing_hook(
+            state,
+            action,
+            next_state,
+            time.perf_counter() - started_at
+        )
+
+    if next_state not in transitions:
+        logging.error(f'Transition {state} -> {next_state} is not allowed')
+        return state
+    return next_state
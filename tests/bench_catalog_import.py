@@ -0,0 +1,126 @@
+"""
+Офлайн-замер пропускной способности `catalog_cli.py import`.
+Вызовы Moltin API подменяются заглушками с фиксированной задержкой,
+ каталог пустой, поэтому каждый товар - это создание, загрузка картинки
+ и привязка картинки (3 запроса).
+
+    python tests/bench_catalog_import.py --products 200 --delay 0.05
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from types import SimpleNamespace
+from unittest import mock
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIR)
+
+import catalog_cli  # noqa: E402
+
+
+def slow_call(delay, result=None):
+    def call(*args, **kwargs):
+        time.sleep(delay)
+        return result
+    return call
+
+
+def run_import(manifest_path, workers, delay):
+    patches = [
+        mock.patch.object(
+            catalog_cli,
+            'load_environment',
+            return_value=('http://moltin.test', 'id', 'secret')
+        ),
+        mock.patch.object(
+            catalog_cli,
+            'get_products',
+            return_value={'data': []}
+        ),
+        mock.patch.object(
+            catalog_cli,
+            'create_a_product',
+            slow_call(delay, {'data': {'id': 'product'}})
+        ),
+        mock.patch.object(
+            catalog_cli,
+            'update_a_product',
+            slow_call(delay)
+        ),
+        mock.patch.object(
+            catalog_cli,
+            'upload_a_file',
+            slow_call(delay, {'data': {'id': 'file'}})
+        ),
+        mock.patch.object(
+            catalog_cli,
+            'create_main_image_relationship',
+            slow_call(delay)
+        ),
+    ]
+    for patch in patches:
+        patch.start()
+    try:
+        args = SimpleNamespace(
+            manifest=manifest_path,
+            images='images',
+            workers=workers,
+            dry_run=False
+        )
+        started_at = time.monotonic()
+        catalog_cli.import_catalog(args)
+        return time.monotonic() - started_at
+    finally:
+        for patch in patches:
+            patch.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Замер импорта каталога на заглушках Moltin API'
+    )
+    parser.add_argument('--products', type=int, default=200)
+    parser.add_argument(
+        '--delay',
+        type=float,
+        default=0.05,
+        help='Задержка одного запроса к API, с'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        nargs='+',
+        default=[1, 4, 16]
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    products = [
+        {'sku': f'sku-{number}', 'name': 'Товар', 'price': 100, 'image': 'x'}
+        for number in range(args.products)
+    ]
+    with tempfile.NamedTemporaryFile(
+            'w',
+            suffix='.json',
+            delete=False
+    ) as manifest:
+        json.dump(products, manifest)
+
+    try:
+        for workers in args.workers:
+            elapsed = run_import(manifest.name, workers, args.delay)
+            print(
+                f'workers={workers}: {args.products} товаров за '
+                f'{elapsed:.2f} с, {args.products / elapsed:.1f} товаров/с'
+            )
+    finally:
+        os.remove(manifest.name)
+
+
+if __name__ == '__main__':
+    main()
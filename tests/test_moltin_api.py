@@ -0,0 +1,82 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+from unittest import mock
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIR)
+
+import moltin_api  # noqa: E402
+
+
+class FakeResponse:
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'data': {'id': 'product'}}
+
+
+class CoalescedGetTest(unittest.TestCase):
+    def setUp(self):
+        moltin_api.COALESCING_STATS.update(requests=0, collapsed=0)
+        patcher = mock.patch.object(
+            moltin_api,
+            'get_token',
+            return_value='token'
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_concurrent_identical_gets_share_one_request(self):
+        calls = []
+
+        def slow_get(*args, **kwargs):
+            calls.append(args)
+            time.sleep(0.2)
+            return FakeResponse()
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    moltin_api.get_products(
+                        'http://moltin.test',
+                        'id',
+                        'secret',
+                        product_id='product'
+                    )
+                )
+            )
+            for _ in range(50)
+        ]
+        with mock.patch.object(moltin_api.requests, 'get', slow_get):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 50)
+        self.assertEqual(
+            moltin_api.get_coalescing_stats(),
+            {'requests': 50, 'collapsed': 49}
+        )
+        self.assertEqual(moltin_api._in_flight_requests, {})
+
+    def test_failed_request_is_released(self):
+        def failing_get(*args, **kwargs):
+            raise KeyboardInterrupt
+
+        with mock.patch.object(moltin_api.requests, 'get', failing_get):
+            with self.assertRaises(KeyboardInterrupt):
+                moltin_api.coalesced_get('http://moltin.test', {})
+
+        self.assertEqual(moltin_api._in_flight_requests, {})
+
+
+if __name__ == '__main__':
+    unittest.main()